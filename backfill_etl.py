@@ -0,0 +1,43 @@
+"""
+Backfill script to bulk load the full history of the stacks into database,
+use it at first run or after the stack list is expanded, instead of the routine process.
+"""
+import argparse
+
+import etl_utils.etl_main as etl
+from etl_utils.etl_backfill import backfill
+from etl_utils.etl_config import RDS_CONFIG, FINNHUB_CONFIG
+from etl_utils.finnhub_functions import RATE_LIMITER
+
+
+def backfill_process(table_names, replace=False):
+    """
+    Backfill the selected tables one by one.
+
+    :param table_names: (list) Database default table names
+    :param replace: (boolean) Replace the whole tables, otherwise only load the stacks not in the tables
+    :return: None
+    """
+    try:
+        for table_name in table_names:
+            with etl.connect_table(table_name) as db_table:
+                failed_list = backfill(db_table, replace=replace)
+                if failed_list:
+                    print("{} stacks failed to backfill into {}, they will be reloaded by the routine process: {}"
+                          .format(len(failed_list), table_name, failed_list))
+    finally:
+        # Export the rate limiter decisions:
+        print("Finnhub API usage: {}".format(RATE_LIMITER.export_metrics(FINNHUB_CONFIG["METRICS_PATH"])))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Bulk load the full history of the stacks into database.")
+    parser.add_argument("--table", choices=["daily", "intraday", "all"], default="all",
+                        help="The table to backfill.")
+    parser.add_argument("--replace", action="store_true",
+                        help="Replace the whole table, otherwise only load the stacks not in the table.")
+    args = parser.parse_args()
+    tables = {"daily": [RDS_CONFIG["DAILY_TABLE"]],
+              "intraday": [RDS_CONFIG["INTRADAY_TABLE"]],
+              "all": [RDS_CONFIG["DAILY_TABLE"], RDS_CONFIG["INTRADAY_TABLE"]]}
+    backfill_process(tables[args.table], replace=args.replace)
@@ -3,12 +3,21 @@ This script is to initialize the AWS RDS PostgreSQL database,
 as well as store modification functions to manage the database
 """
 
+import os
+import re
+import gzip
 import pandas as pd
 import psycopg2
 from datetime import datetime
-from sqlalchemy import create_engine, MetaData, Column, String, Float, DateTime, Integer, BigInteger, Date, Table
+from threading import Thread, Lock
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from sqlalchemy import create_engine, MetaData, Column, String, Float, DateTime, Integer, BigInteger, Date, Table, \
+    Index
 from etl_utils.etl_config import RDS_CONFIG
 
+# Avoid the daily and intraday threads creating the reload log table at the same time:
+reload_lock = Lock()
+
 
 class RemoteDatabase:
     """
@@ -58,6 +67,16 @@ class RemoteDatabase:
             rs.columns = ['symbol', 'last_time', 'volume']
             return rs
 
+    def stack_symbols(self):
+        """
+        Get the stacks already in the table.
+
+        :return: (list)
+        """
+        with self.engine.connect() as con:
+            rs = con.execute("SELECT DISTINCT symbol FROM {}".format(self.tb_name)).fetchall()
+            return [row[0] for row in rs]
+
     def _create_table(self):
         """
         Build three main tables to save 'daily' candles, 'intraday minute level' candles, and 'splits' information.
@@ -78,7 +97,8 @@ class RemoteDatabase:
                                        Column('timestamp', DateTime(timezone=True),
                                               default=datetime.utcnow),
                                        Column('volume', BigInteger()),
-                                       Column('symbol', String(255)))
+                                       Column('symbol', String(255)),
+                                       Index('{}_symbol_timestamp_idx'.format(self.tb_name), 'symbol', 'timestamp'))
         elif self.tb_name == RDS_CONFIG['SPLIT_TABLE']:
             self.current_table = Table(self.tb_name, self.metadata,
                                        Column('symbol', String(255), primary_key=True),
@@ -107,6 +127,15 @@ class RemoteDatabase:
         self.current_table.drop(self.engine)
         print("----- TABLE [{}] DOPED -----".format(self.tb_name))
 
+    def _connect(self):
+        """
+        Build a psycopg2 connection for bulk operations.
+
+        :return: (connection)
+        """
+        return psycopg2.connect(database=self.db_name, user=self.user_name,
+                                password=self.password, host=self.endpoint, port=RDS_CONFIG["PORT"])
+
     def update_dataframe(self, df):
         """
         :param df: (DataFrame)
@@ -117,8 +146,7 @@ class RemoteDatabase:
             print("Nothing to upload.")
             return None
         # Build Bulk insert connection to upload:
-        up_con = psycopg2.connect(database=self.db_name, user=self.user_name,
-                                  password=self.password, host=self.endpoint, port=RDS_CONFIG["PORT"])
+        up_con = self._connect()
         tmp_df = "./tmp_dataframe.csv"
         df.to_csv(tmp_df, index=False, header=False)
         f = open(tmp_df, 'r')
@@ -182,7 +210,377 @@ class RemoteDatabase:
         :return: None. Only process operations in database.
         """
         print("Delete all records of {} from {}".format(symbol, self.tb_name))
-        with self.engine.connect() as con:
+        self._create_reload_log()
+        with self.engine.begin() as con:
             query = "DELETE FROM {} WHERE symbol = '{}'".format(self.tb_name, symbol)
             res = con.execute(query)
+            self._log_reload(con, "SELECT %(symbol)s::text AS symbol", symbol=symbol)
             print("{} rows has been deleted.".format(res.rowcount))
+
+    def _create_reload_log(self):
+        """
+        Create the table to record the stacks whose records are rewritten in place.
+        """
+        with reload_lock:
+            with self.engine.connect() as con:
+                con.execute("CREATE TABLE IF NOT EXISTS {} (tb_name VARCHAR(255), symbol VARCHAR(255), "
+                            "reload_time TIMESTAMP WITH TIME ZONE)".format(RDS_CONFIG["RELOAD_TABLE"]))
+
+    def _log_reload(self, con, query, **params):
+        """
+        Record the stacks whose records are rewritten, so that the export process sends them again in full.
+
+        :param con: (Connection) Database connection, in the same transaction as the rewriting
+        :param query: (str) SELECT query returns the 'symbol' column
+        :param params: Query parameters
+        :return: None. Only process operations in database.
+        """
+        con.execute("INSERT INTO {} SELECT %(tb_name)s, s.symbol, clock_timestamp() FROM ({}) s"
+                    .format(RDS_CONFIG["RELOAD_TABLE"], query), tb_name=self.tb_name, **params)
+
+    def create_staging(self):
+        """
+        Create an unlogged copy of the current table without indexes, to bulk load data quickly.
+
+        :return: (str) The staging table name
+        """
+        staging_name = "{}_staging".format(self.tb_name)
+        print("----- CREATING STAGING TABLE [{}] -----".format(staging_name))
+        with self.engine.begin() as con:
+            con.execute("DROP TABLE IF EXISTS {}".format(staging_name))
+            con.execute("CREATE UNLOGGED TABLE {} (LIKE {} INCLUDING DEFAULTS)".format(staging_name, self.tb_name))
+        return staging_name
+
+    def copy_file(self, file_path, tb_name):
+        """
+        Bulk load a csv file into the table through COPY, each call uses its own connection,
+        so that several calls can run in parallel.
+
+        :param file_path: (str) csv file without header, columns in table order
+        :param tb_name: (str) The table to load into
+        :return: None. Only process operations in database.
+        """
+        up_con = self._connect()
+        cursor = up_con.cursor()
+        try:
+            # The staging table is dropped on failure, no need to wait for the WAL flush:
+            cursor.execute("SET synchronous_commit TO off")
+            with open(file_path, 'r') as f:
+                cursor.copy_from(f, tb_name, sep=",", size=RDS_CONFIG["CHUNK_SIZE"])
+            up_con.commit()
+        except (Exception, psycopg2.DatabaseError):
+            up_con.rollback()
+            raise
+        finally:
+            cursor.close()
+            up_con.close()
+
+    def drop_staging(self, staging_name):
+        """
+        Drop the staging table, e.g. when the backfill failed.
+
+        :param staging_name: (str) The staging table name
+        :return: None. Only process operations in database.
+        """
+        print("----- DROP STAGING TABLE [{}] -----".format(staging_name))
+        with self.engine.begin() as con:
+            con.execute("DROP TABLE IF EXISTS {}".format(staging_name))
+
+    def _has_dependents(self, con):
+        """
+        Check if any view, constraint, foreign key or trigger depends on the current table,
+        which would be lost or block the DROP when the table is swapped.
+
+        :param con: (Connection) Database connection
+        :return: (boolean)
+        """
+        rs = con.execute("SELECT "
+                         "(SELECT COUNT(*) FROM pg_depend d JOIN pg_rewrite r ON d.objid = r.oid "
+                         "WHERE d.refobjid = %(tb)s::regclass AND r.ev_class <> %(tb)s::regclass) + "
+                         "(SELECT COUNT(*) FROM pg_constraint WHERE contype <> 'n' "
+                         "AND (conrelid = %(tb)s::regclass OR confrelid = %(tb)s::regclass)) + "
+                         "(SELECT COUNT(*) FROM pg_trigger WHERE tgrelid = %(tb)s::regclass AND NOT tgisinternal)",
+                         tb=self.tb_name).scalar()
+        return rs > 0
+
+    def swap_staging(self, staging_name, replace=False, keep_symbols=None):
+        """
+        Build indexes on the loaded staging table, then move it into the current table.
+        When replace, the staging table takes the owner, privileges and indexes of the current table
+        before it is renamed over it. Comments, statistics settings and row level security are not carried over.
+        If views, constraints, foreign keys or triggers depend on the current table, it is truncated and
+        refilled from the staging table in the same transaction instead, which writes the records twice.
+        A table referenced by foreign keys cannot be truncated, so it cannot be replaced.
+
+        :param staging_name: (str) The staging table name
+        :param replace: (boolean) Replace the whole current table by the staging table,
+        otherwise append the staging records into the current table
+        :param keep_symbols: (list) Stacks to keep their current records when replace, e.g. failed to reload
+        :return: None. Only process operations in database.
+        """
+        index_name = "{}_symbol_timestamp_idx".format(self.tb_name)
+        print("----- SWAP [{}] INTO [{}] -----".format(staging_name, self.tb_name))
+        self._create_reload_log()
+        with self.engine.begin() as con:
+            con.execute("SET LOCAL maintenance_work_mem = '{}'".format(RDS_CONFIG["INDEX_MEMORY"]))
+            self._log_reload(con, "SELECT DISTINCT symbol FROM {}".format(staging_name))
+            if replace and keep_symbols:
+                con.execute("INSERT INTO {} SELECT * FROM {} WHERE symbol = ANY(%(symbols)s)"
+                            .format(staging_name, self.tb_name), symbols=list(keep_symbols))
+            if replace and not self._has_dependents(con):
+                # Rebuild the indexes of the current table on the staging table before it goes live:
+                indexes = con.execute("SELECT indexname, quote_ident(indexname), indexdef FROM pg_indexes "
+                                      "WHERE schemaname = current_schema() AND tablename = %(tb)s",
+                                      tb=self.tb_name).fetchall()
+                renames = []
+                for i, (name, quoted_name, indexdef) in enumerate(indexes):
+                    swap_index = "{}_idx{}".format(staging_name, i)
+                    swap_def, found = re.subn(r'INDEX ("(?:[^"]|"")+"|\S+) ON (ONLY )?(\S+\.)?{} '
+                                              .format(re.escape(self.tb_name)),
+                                              'INDEX {} ON {} '.format(swap_index, staging_name), indexdef, count=1)
+                    if not found:
+                        raise Exception("Cannot rebuild the index {} on the staging table.".format(name))
+                    con.execute(swap_def)
+                    renames.append((swap_index, quoted_name))
+                if index_name not in [index[0] for index in indexes]:
+                    swap_index = "{}_idx{}".format(staging_name, len(indexes))
+                    con.execute("CREATE INDEX {} ON {} (symbol, timestamp)".format(swap_index, staging_name))
+                    renames.append((swap_index, index_name))
+                con.execute("ALTER TABLE {} SET LOGGED".format(staging_name))
+                # Take the owner and privileges of the current table:
+                owner = con.execute("SELECT quote_ident(pg_get_userbyid(relowner)) FROM pg_class "
+                                    "WHERE oid = %(tb)s::regclass", tb=self.tb_name).scalar()
+                con.execute("ALTER TABLE {} OWNER TO {}".format(staging_name, owner))
+                grants = con.execute("SELECT CASE WHEN a.grantee = 0 THEN 'PUBLIC' "
+                                     "ELSE quote_ident(pg_get_userbyid(a.grantee)) END, "
+                                     "a.privilege_type, a.is_grantable "
+                                     "FROM pg_class c, aclexplode(c.relacl) a "
+                                     "WHERE c.oid = %(tb)s::regclass AND a.grantee <> c.relowner",
+                                     tb=self.tb_name).fetchall()
+                for grantee, privilege, grantable in grants:
+                    con.execute("GRANT {} ON {} TO {}{}".format(privilege, staging_name, grantee,
+                                                                " WITH GRANT OPTION" if grantable else ""))
+                con.execute("DROP TABLE {}".format(self.tb_name))
+                con.execute("ALTER TABLE {} RENAME TO {}".format(staging_name, self.tb_name))
+                for swap_index, name in renames:
+                    con.execute("ALTER INDEX {} RENAME TO {}".format(swap_index, name))
+            else:
+                if replace:
+                    print("Objects depend on [{}], refill it instead of swap.".format(self.tb_name))
+                    con.execute("TRUNCATE TABLE {}".format(self.tb_name))
+                con.execute("INSERT INTO {} SELECT * FROM {} ORDER BY symbol, timestamp".format(self.tb_name,
+                                                                                              staging_name))
+                con.execute("DROP TABLE {}".format(staging_name))
+                con.execute("CREATE INDEX IF NOT EXISTS {} ON {} (symbol, timestamp)".format(index_name,
+                                                                                          self.tb_name))
+        self.metadata.clear()
+        self.current_table = Table(self.tb_name, self.metadata, autoload=True)
+        print("----- [{}] SWAPPED -----".format(self.tb_name))
+
+    def export_table(self, out_dir, file_format='csv', parts=1, full=False):
+        """
+        Export the records since the last export into compressed files, streamed by COPY TO STDOUT.
+        The watermark is kept for each stack, and only the records above it are read. The stacks rewritten in place
+        since the last export, recorded in the reload log by 'delete_stack' and 'swap_staging', are exported
+        in full again. The stacks and their upper bounds are found through the (symbol, timestamp) index,
+        about two index lookups for each stack, so the table is not scanned.
+        The split table is small and can be changed in the past, so it is always fully exported.
+        Each run is saved in its own folder with a '_manifest.csv' of the exported stacks, periods and modes:
+        the records of a 'new', 'reload' or 'full' stack replace all its previous records, 'append' adds to them,
+        and a 'delete' stack is no longer in the table.
+
+        :param out_dir: (str) Folder to save the exported files, one sub folder for each table
+        :param file_format: (str) 'csv' for gzip csv, 'parquet' for snappy parquet (requires pyarrow)
+        :param parts: (int) Number of symbol ranges to export in parallel, each range has its own file
+        :param full: (boolean) Ignore the watermark and export the whole table
+        :return: (list) The exported file paths
+        """
+        if file_format not in ['csv', 'parquet']:
+            raise Exception("Sorry, exporting to {} is not supported.".format(file_format))
+        if self.tb_name == RDS_CONFIG['SPLIT_TABLE']:
+            time_col, time_type, full = 'date', 'date', True
+        else:
+            time_col, time_type = 'timestamp', 'timestamptz'
+        start_time = datetime.utcnow()
+        tb_dir = os.path.join(out_dir, self.tb_name)
+        os.makedirs(tb_dir, exist_ok=True)
+        watermark_path = os.path.join(tb_dir, "_watermark.csv")
+        export_time_path = os.path.join(tb_dir, "_export_time")
+        watermark, last_export = {}, None
+        if not full and os.path.exists(watermark_path) and os.path.exists(export_time_path):
+            watermark = dict(pd.read_csv(watermark_path, dtype=str)[['symbol', 'last_time']].values.tolist())
+            with open(export_time_path, 'r') as f:
+                last_export = f.read().strip()
+
+        # Fix the upper bound of each stack at start, so that the newer records are left to the next time:
+        with self.engine.connect() as con:
+            export_time = con.execute("SELECT now()").scalar()
+            # Walk through the stacks by the index instead of scanning the table:
+            stacks = con.execute("WITH RECURSIVE s AS ("
+                                 "(SELECT symbol FROM {0} ORDER BY symbol LIMIT 1) UNION ALL "
+                                 "SELECT (SELECT symbol FROM {0} WHERE symbol > s.symbol ORDER BY symbol LIMIT 1) "
+                                 "FROM s WHERE s.symbol IS NOT NULL) "
+                                 "SELECT s.symbol, (SELECT MAX(t.{1}) FROM {0} t WHERE t.symbol = s.symbol) "
+                                 "FROM s WHERE s.symbol IS NOT NULL ORDER BY s.symbol"
+                                 .format(self.tb_name, time_col)).fetchall()
+            reloaded = set()
+            if last_export is not None and \
+                    con.execute("SELECT to_regclass(%(tb)s)", tb=RDS_CONFIG["RELOAD_TABLE"]).scalar():
+                rs = con.execute("SELECT DISTINCT symbol FROM {} WHERE tb_name = %(tb_name)s "
+                                 "AND reload_time > %(since)s".format(RDS_CONFIG["RELOAD_TABLE"]),
+                                 tb_name=self.tb_name, since=last_export).fetchall()
+                reloaded = {row[0] for row in rs}
+
+        # Decide the exported period of each stack:
+        manifest = []
+        for symbol, upper in stacks:
+            if full:
+                manifest.append([symbol, None, upper, 'full'])
+            elif symbol not in watermark:
+                manifest.append([symbol, None, upper, 'new'])
+            elif symbol in reloaded:
+                manifest.append([symbol, None, upper, 'reload'])
+            elif upper > datetime.fromisoformat(watermark[symbol]):
+                manifest.append([symbol, watermark[symbol], upper, 'append'])
+        existed = {symbol for symbol, _ in stacks}
+        manifest.extend([symbol, None, None, 'delete'] for symbol in sorted(watermark) if symbol not in existed)
+        if not manifest:
+            print("Nothing new to export from {}.".format(self.tb_name))
+            return []
+        print("----- EXPORT [{}] {} STACKS -----".format(self.tb_name, len(manifest)))
+
+        # Each run has its own folder, the full run is marked to replace all the previous runs:
+        run_dir = os.path.join(tb_dir, "run_{}_{}".format(start_time.strftime('%Y%m%d%H%M%S%f'),
+                                                          'full' if full else 'incremental'))
+        os.makedirs(run_dir)
+        exported_stacks = [row for row in manifest if row[3] != 'delete']
+        size = max(1, -(-len(exported_stacks) // max(parts, 1)))
+        exported = []
+        with ThreadPoolExecutor(max_workers=max(parts, 1)) as executor:
+            tasks = []
+            for i in range(0, len(exported_stacks), size):
+                part = exported_stacks[i:i + size]
+                # Keep the lower bound usable by the (symbol, timestamp) index for each stack:
+                query = "SELECT t.* FROM unnest(%(symbols)s::text[], %(since)s::{2}[], %(upper)s::{2}[]) " \
+                        "AS w(symbol, since, upper) JOIN {0} t ON t.symbol = w.symbol " \
+                        "AND t.{1} > COALESCE(w.since, '-infinity'::{2}) AND t.{1} <= w.upper " \
+                        "ORDER BY t.symbol, t.{1}".format(self.tb_name, time_col, time_type)
+                params = {'symbols': [row[0] for row in part],
+                          'since': [row[1] for row in part],
+                          'upper': [row[2] for row in part]}
+                file_path = os.path.join(run_dir, "part_{}.{}".format(i // size, 'csv.gz' if file_format == 'csv'
+                                                                      else 'parquet'))
+                tasks.append(executor.submit(self._export_part, query, params, file_path, time_col))
+            for task in as_completed(tasks):
+                file_path = task.result()
+                if file_path is not None:
+                    exported.append(file_path)
+        pd.DataFrame(manifest, columns=['symbol', 'since', 'upper', 'mode']).to_csv(
+            os.path.join(run_dir, "_manifest.csv"), index=False)
+
+        # Only move the watermark when all the parts are exported:
+        if self.tb_name != RDS_CONFIG['SPLIT_TABLE']:
+            pd.DataFrame([[symbol, upper.isoformat()] for symbol, upper in stacks],
+                         columns=['symbol', 'last_time']).to_csv(watermark_path, index=False)
+            with open(export_time_path, 'w') as f:
+                f.write(export_time.isoformat())
+        print("----- [{}] EXPORTED INTO {} FILES -----".format(self.tb_name, len(exported)))
+        return sorted(exported)
+
+    def _export_part(self, query, params, file_path, time_col):
+        """
+        Stream the query result into one file through COPY TO STDOUT, in bounded memory.
+
+        :param query: (str) SELECT query with %(name)s placeholders
+        :param params: (dict) Query parameters
+        :param file_path: (str) Ends with '.csv.gz' or '.parquet'
+        :param time_col: (str) The time column to parse for parquet
+        :return: (str) The file path, None if no records
+        """
+        ex_con = self._connect()
+        ex_con.set_session(readonly=True)
+        cursor = ex_con.cursor()
+        query = cursor.mogrify(query, params).decode()
+        tmp_path = file_path + ".tmp"
+        try:
+            if file_path.endswith('.csv.gz'):
+                with gzip.open(tmp_path, 'wb', compresslevel=6) as f:
+                    writer = _HeaderWriter(f, ",".join(self.current_table.columns.keys()))
+                    cursor.copy_expert("COPY ({}) TO STDOUT WITH (FORMAT csv)".format(query), writer,
+                                       size=RDS_CONFIG["CHUNK_SIZE"])
+                has_records = writer.written
+            else:
+                has_records = _copy_to_parquet(cursor, "COPY ({}) TO STDOUT WITH (FORMAT csv, HEADER)"
+                                               .format(query), tmp_path, time_col)
+            if not has_records:
+                return None
+            os.replace(tmp_path, file_path)
+            return file_path
+        finally:
+            cursor.close()
+            ex_con.close()
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+
+class _HeaderWriter:
+    """
+    Write the csv header before the first COPY chunk, so that no records means nothing written.
+    """
+
+    def __init__(self, f, header):
+        self.f, self.header, self.written = f, header, False
+
+    def write(self, data):
+        if not self.written:
+            self.f.write((self.header + "\n").encode())
+            self.written = True
+        return self.f.write(data)
+
+
+def _copy_to_parquet(cursor, copy_sql, file_path, time_col):
+    """
+    Pipe the COPY output through pandas chunks into a parquet file.
+
+    :param cursor: (cursor) psycopg2 cursor
+    :param copy_sql: (str) COPY ... TO STDOUT WITH (FORMAT csv, HEADER)
+    :param file_path: (str) The parquet file path
+    :param time_col: (str) The time column to parse
+    :return: (boolean) False if no records
+    """
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise Exception('Please install "pyarrow" to export parquet files.')
+    read_fd, write_fd = os.pipe()
+    copy_errors = []
+
+    def produce():
+        with os.fdopen(write_fd, 'wb') as writer:
+            try:
+                cursor.copy_expert(copy_sql, writer, size=RDS_CONFIG["CHUNK_SIZE"])
+            except Exception as e:
+                copy_errors.append(e)
+
+    producer = Thread(target=produce)
+    producer.start()
+    pq_writer = None
+    try:
+        with os.fdopen(read_fd, 'rb') as reader:
+            for chunk in pd.read_csv(reader, chunksize=RDS_CONFIG["CHUNK_SIZE"], parse_dates=[time_col]):
+                if chunk.empty:
+                    continue
+                table = pa.Table.from_pandas(chunk, preserve_index=False)
+                if pq_writer is None:
+                    pq_writer = pq.ParquetWriter(file_path, table.schema, compression='snappy')
+                else:  # Keep the types of all chunks the same as the first one
+                    table = table.cast(pq_writer.schema)
+                pq_writer.write_table(table)
+    finally:
+        producer.join()
+        if pq_writer is not None:
+            pq_writer.close()
+    if copy_errors:
+        raise copy_errors[0]
+    return pq_writer is not None
@@ -0,0 +1,153 @@
+"""
+This is the bulk backfill process script,
+to load the full history of many stacks at once, e.g. at first run or when the stack list is expanded.
+The stacks are extracted concurrently, spooled into large sorted batches, and loaded by parallel COPY
+into an unlogged staging table, which is indexed and swapped into the live table at the end.
+"""
+
+import os
+import shutil
+import tempfile
+import pandas as pd
+from datetime import datetime, timezone, timedelta
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from stack_info import STACK_LIST, STACK_NO_DATA, check_path
+from etl_utils.finnhub_functions import extract_candles, extract_intraday, FinnhubRequestError
+from etl_utils.etl_config import RDS_CONFIG, USER_CUSTOM
+
+
+def extract_history(symbol, db_table, current_time):
+    """
+    Extract the full history of the stack, the same period as the reload process.
+
+    :param symbol: (str) Stack abbreviation
+    :param db_table: (RemoteDatabase) Remote Database Object
+    :param current_time: (datetime) The right end datetime
+    :return: (DataFrame) empty dataframe if no data
+    """
+    if db_table.tb_name == RDS_CONFIG['DAILY_TABLE']:
+        return extract_candles(symbol, current_time - timedelta(days=365 * 19), current_time)
+    else:
+        return extract_intraday(symbol, current_time - timedelta(days=365), current_time,
+                                db_table, upload=False)
+
+
+def _spool_batch(frames, spool_dir, batch_no):
+    """
+    Sort the spooled records and write them into one csv file to COPY.
+
+    :param frames: (list) DataFrames of the spooled stacks
+    :param spool_dir: (str) Folder to save the batch files
+    :param batch_no: (int) Batch number
+    :return: (str) The batch file path
+    """
+    batch_df = pd.concat(frames, ignore_index=True).sort_values(['symbol', 'timestamp'])
+    batch_path = os.path.join(spool_dir, "batch_{}.csv".format(batch_no))
+    batch_df.to_csv(batch_path, index=False, header=False)
+    return batch_path
+
+
+def _copy_batch(db_table, batch_path, staging_name):
+    """
+    COPY one batch file into the staging table, then remove the file.
+
+    :param db_table: (RemoteDatabase) Remote Database Object
+    :param batch_path: (str) The batch file path
+    :param staging_name: (str) The staging table name
+    :return: None. Only process operations in database.
+    """
+    db_table.copy_file(batch_path, staging_name)
+    os.remove(batch_path)
+
+
+def backfill(db_table, symbols=None, replace=False):
+    """
+    Bulk load the full history of the stacks into the table.
+
+    :param db_table: (RemoteDatabase) Remote Database Object
+    :param symbols: (list) Stacks to load, default to the whole stack list
+    :param replace: (boolean) Replace the whole table by the loaded stacks, otherwise append to the table.
+    The existing records of the stacks failed to extract are kept when replace.
+    :return: (list) The stacks failed to extract, they are left to the routine process
+    """
+    if db_table.tb_name not in [RDS_CONFIG['DAILY_TABLE'], RDS_CONFIG['INTRADAY_TABLE']]:
+        raise Exception("Sorry, the backfill process cannot support this table.")
+    real_now_time = datetime.today().astimezone(timezone.utc)
+    current_time = real_now_time - timedelta(hours=USER_CUSTOM["POSTPONE"])
+    if symbols is None:
+        symbols = STACK_LIST["name"].values.tolist()
+    # Only the new stacks are loaded when append:
+    if not replace:
+        existed = set(db_table.stack_symbols())
+        symbols = [symbol for symbol in symbols if symbol not in existed]
+        # Nothing to keep in an empty table, swap the staging table in rather than writing the records twice:
+        replace = not existed
+    if db_table.tb_name == RDS_CONFIG['INTRADAY_TABLE']:
+        no_data = set(STACK_NO_DATA["symbol"].values.tolist())
+        symbols = [symbol for symbol in symbols if symbol not in no_data]
+    if not symbols:
+        print("Nothing to backfill.")
+        return []
+    print("Backfill {} stacks into {}".format(len(symbols), db_table.tb_name))
+
+    staging_name = db_table.create_staging()
+    spool_dir = tempfile.mkdtemp(prefix="{}_".format(staging_name))
+    frames, spool_rows, batch_no = [], 0, 0
+    fetch_tasks, copy_tasks, failed_list, empty_list = {}, [], [], []
+    fetch_executor = ThreadPoolExecutor(max_workers=USER_CUSTOM["BACKFILL_WORKERS"])
+    copy_executor = ThreadPoolExecutor(max_workers=RDS_CONFIG["COPY_STREAMS"])
+    swapped = False
+    try:
+        try:
+            fetch_tasks = {fetch_executor.submit(extract_history, symbol, db_table, current_time): symbol
+                           for symbol in symbols}
+            for task in as_completed(fetch_tasks):
+                symbol = fetch_tasks.pop(task)  # Release the result once spooled
+                # Stop at the first failed COPY rather than after all the extracting:
+                for copy_task in copy_tasks:
+                    if copy_task.done():
+                        copy_task.result()
+                try:
+                    stack_hist_df = task.result()
+                except FinnhubRequestError as e:
+                    print("Skip {} | {}".format(symbol, e))
+                    failed_list.append(symbol)
+                    continue
+                if stack_hist_df.empty:
+                    empty_list.append(symbol)
+                    continue
+                frames.append(stack_hist_df)
+                spool_rows += len(stack_hist_df)
+                # Flush the spool as one large batch:
+                if spool_rows >= RDS_CONFIG["BATCH_ROWS"]:
+                    batch_path = _spool_batch(frames, spool_dir, batch_no)
+                    copy_tasks.append(copy_executor.submit(_copy_batch, db_table, batch_path, staging_name))
+                    frames, spool_rows, batch_no = [], 0, batch_no + 1
+            if frames:
+                batch_path = _spool_batch(frames, spool_dir, batch_no)
+                copy_tasks.append(copy_executor.submit(_copy_batch, db_table, batch_path, staging_name))
+            # Make sure all the batches are loaded, raise if any COPY failed:
+            for task in as_completed(copy_tasks):
+                task.result()
+        finally:
+            # Left only when failed, drop the queued works:
+            for task in list(fetch_tasks) + copy_tasks:
+                task.cancel()
+            fetch_executor.shutdown(wait=True)
+            copy_executor.shutdown(wait=True)
+            shutil.rmtree(spool_dir, ignore_errors=True)
+        # Build indexes and move the staging table into the live one:
+        db_table.swap_staging(staging_name, replace=replace, keep_symbols=failed_list)
+        swapped = True
+    finally:
+        # Do not leave the large unlogged table in the database when failed:
+        if not swapped:
+            db_table.drop_staging(staging_name)
+
+    # Record the stacks without intraday data, the same as the reload process:
+    if db_table.tb_name == RDS_CONFIG['INTRADAY_TABLE'] and empty_list:
+        no_data_list = STACK_NO_DATA.append(pd.DataFrame(empty_list, columns=['symbol']), ignore_index=True)
+        no_data_list.to_csv(check_path, index=False)
+    print("Backfill finished: {} loaded, {} no data, {} failed.".format(
+        len(symbols) - len(failed_list) - len(empty_list), len(empty_list), len(failed_list)))
+    return failed_list
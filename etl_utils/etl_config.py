@@ -24,14 +24,28 @@ RDS_CONFIG = {
     "DAILY_TABLE": 'daily_raw',
     "INTRADAY_TABLE": 'intraday_raw',
     "SPLIT_TABLE": 'split_ref',
-    "CHUNK_SIZE": 100000
+    "RELOAD_TABLE": 'reload_log',  # records the stacks rewritten in place, for the export process
+    "CHUNK_SIZE": 100000,
+    "BATCH_ROWS": 1000000,  # how many rows to spool before one bulk COPY when backfill
+    "COPY_STREAMS": 4,  # how many COPY run in parallel when backfill
+    "INDEX_MEMORY": '1GB',  # maintenance_work_mem to build the indexes after backfill
+    "EXPORT_PATH": join(dirname(dirname(__file__)), 'export')  # where to export the tables for downstream use
 }
 
 # Load Finnhub information:
 FINNHUB_CONFIG = {
     "API_KEY": os.getenv("FINNHUB_API_KEY"),
     # ----- CUSTOM PART -----
-    "API_LIMIT": 1.25,  # control how long time that the API can be used again.
+    "API_URL": "https://finnhub.io/api/v1",
+    "API_LIMIT": 1.25,  # control how long time that the API can be used again at start.
+    "API_MIN_LIMIT": 0.2,  # the shortest interval before the real quota is learned from the API.
+    "API_MAX_LIMIT": 10,  # the longest interval after being throttled repeatedly.
+    "API_INCREASE": 0.02,  # calls per second added to the rate after each successful call.
+    "API_DECREASE": 0.5,  # factor multiplied to the rate when throttled.
+    "API_WINDOW": 60,  # seconds of the quota window in the rate-limit headers.
+    "API_RETRY": 3,  # how many times to retry a throttled or failed call.
+    "API_TIMEOUT": 30,  # seconds to wait for the API response.
+    "METRICS_PATH": join(dirname(__file__), 'rate_metrics.csv'),  # where to export the limiter metrics.
     "INTRADAY_LIMIT": '30D'  # Finnhub limits the intraday data return period as 30 days.
 }
 
@@ -55,6 +69,7 @@ USER_CUSTOM = {
     "T_LEVEL": 0.005,  # Tolerance level to the inconsistent data
     "T_NUMBER": 1000,  # The threshold number to judge the inconsistent data
     "ALERT": True,  # Allow the email and message services
-    "MULTILINE": True  # Allow the process run parallel
+    "MULTILINE": True,  # Allow the process run parallel
+    "BACKFILL_WORKERS": 8  # How many stacks to extract at the same time when backfill
 
 }
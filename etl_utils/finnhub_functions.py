@@ -4,36 +4,81 @@ This Script is designed to extract data from Finnhub.io
 import time
 import pandas as pd
 import requests
-import finnhub
-from functools import wraps
 from datetime import datetime, timezone
 from etl_utils.etl_config import FINNHUB_CONFIG
+from etl_utils.rate_limiter import AdaptiveRateLimiter, OUTCOME_OK, OUTCOME_EMPTY, OUTCOME_THROTTLED, \
+    OUTCOME_FAILED
 from stack_info import total_lock
 
+# Shared by all the threads to pace the Finnhub API usage:
+RATE_LIMITER = AdaptiveRateLimiter(interval=FINNHUB_CONFIG["API_LIMIT"],
+                                   min_interval=FINNHUB_CONFIG["API_MIN_LIMIT"],
+                                   max_interval=FINNHUB_CONFIG["API_MAX_LIMIT"],
+                                   increase=FINNHUB_CONFIG["API_INCREASE"],
+                                   decrease=FINNHUB_CONFIG["API_DECREASE"],
+                                   window=FINNHUB_CONFIG["API_WINDOW"],
+                                   lock=total_lock)
 
-def limit_usage(func):
+
+class FinnhubRequestError(Exception):
+    """
+    Raised when a request is still throttled or failed after the retries,
+    so that it will not be mistaken as "no data".
+    """
+
+    def __init__(self, symbol, outcome, reason):
+        self.symbol, self.outcome, self.reason = symbol, outcome, reason
+        super().__init__("Request of {} {}: {}".format(symbol, outcome, reason))
+
+
+def request_api(path, params, symbol):
     """
-    Use decorator to limit the Finnhub API usage.
+    Send the request to Finnhub API under the rate limiter,
+    retry if throttled, server error or network error.
 
-    :param func: Extracting Function.
-    :return: None
+    :param path: (str) API path, e.g. '/stock/candle'
+    :param params: (dict) Query parameters
+    :param symbol: (str) Stack abbreviation, for error message
+    :return: (str, dict/list) The outcome and the json response, the outcome is OUTCOME_OK or OUTCOME_EMPTY
     """
-    last_use_time = 0
-
-    @wraps(func)
-    def wrapper(*args, **kwargs):
-        total_lock.acquire()
-        nonlocal last_use_time
-        t = time.time() - last_use_time
-        if t >= FINNHUB_CONFIG["API_LIMIT"]:
-            last_use_time = time.time()
+    api_url = FINNHUB_CONFIG["API_URL"] + path
+    api_head = {'X-Finnhub-Token': FINNHUB_CONFIG["API_KEY"]}
+    outcome, reason = OUTCOME_FAILED, None
+    retries = FINNHUB_CONFIG["API_RETRY"]
+    for attempt in range(retries + 1):
+        RATE_LIMITER.wait()
+        status_code, headers = None, None
+        try:
+            res = requests.get(api_url, params=params, headers=api_head, timeout=FINNHUB_CONFIG["API_TIMEOUT"])
+        except requests.RequestException as e:
+            outcome, reason = OUTCOME_FAILED, e.__class__
         else:
-            time.sleep(FINNHUB_CONFIG["API_LIMIT"] - t + 0.1)
-            last_use_time = time.time()
-        total_lock.release()
-        return func(*args, **kwargs)
-
-    return wrapper
+            status_code, headers = res.status_code, res.headers
+            if status_code == 429:
+                outcome, reason = OUTCOME_THROTTLED, status_code
+            elif status_code != 200:
+                outcome, reason = OUTCOME_FAILED, status_code
+            else:
+                try:
+                    data = res.json()
+                except ValueError as e:
+                    outcome, reason = OUTCOME_FAILED, e.__class__
+                else:
+                    # Finnhub answers "no_data" for candles and an empty list for splits:
+                    if not data or (isinstance(data, dict) and data.get('s') == 'no_data'):
+                        outcome = OUTCOME_EMPTY
+                    else:
+                        outcome = OUTCOME_OK
+                    RATE_LIMITER.feedback(outcome, status_code, headers)
+                    return outcome, data
+        RATE_LIMITER.feedback(outcome, status_code, headers)
+        # A bad key, symbol or response will not be fixed by retry:
+        if outcome == OUTCOME_FAILED and status_code is not None and status_code < 500:
+            break
+        if outcome == OUTCOME_FAILED and attempt < retries:
+            # Give the server or network a moment before retry:
+            time.sleep(2 ** attempt)
+    raise FinnhubRequestError(symbol, outcome, reason)
 
 
 def convert_datetime(date_time):
@@ -56,7 +101,6 @@ def convert_datetime(date_time):
     return dt_stamp
 
 
-@limit_usage
 def extract_candles(symbol, dt_start, dt_end, resolution='D'):
     """
     Extract stack candles data through Finnhub API
@@ -66,46 +110,36 @@ def extract_candles(symbol, dt_start, dt_end, resolution='D'):
     :param dt_end: (datetime)
     :param resolution: Supported resolution includes 1, 5, 15, 30, 60, D, W, M.
     Some time frames might not be available depending on the exchange.
-    :return: (DataFrame) empty dataframe if false to download
+    :return: (DataFrame) empty dataframe if no data, raise FinnhubRequestError if throttled or failed
     """
-    finnhub_client = finnhub.Client(api_key=FINNHUB_CONFIG["API_KEY"])
     # Download the historical daily data from Finnhub:
-    try:
-        res = finnhub_client.stock_candles(symbol, resolution,
-                                           convert_datetime(dt_start),
-                                           convert_datetime(dt_end))
-        # print('api called time{}'.format(datetime.today().strftime("%H:%M:%S")))
-    except Exception as e:
-        print('Sorry, when extract {0} candles, because of {1}, '
-              'your request cannot be finished.'.format(symbol, e.__class__))
+    outcome, res = request_api('/stock/candle', {'symbol': symbol,
+                                                 'resolution': resolution,
+                                                 'from': convert_datetime(dt_start),
+                                                 'to': convert_datetime(dt_end)}, symbol)
+    if outcome == OUTCOME_EMPTY:
+        if resolution != '1':
+            print('{0} has no data returned from {1} to {2}.'.format(symbol, dt_start, dt_end))
         return pd.DataFrame()
     else:
-        if res['s'] == 'no_data':
-            if resolution == '1':
-                return pd.DataFrame()
-            else:
-                print('{0} has no data returned from {1} to {2}.'.format(symbol, dt_start, dt_end))
-                return pd.DataFrame()
-        else:
-            finnhub_data = pd.DataFrame(res)
-            finnhub_data["symbol"] = symbol
-            # Convert the timestamp column to readable form:
-            finnhub_data["t"] = finnhub_data["t"].apply(lambda x:
-                                                        datetime.fromtimestamp(x).astimezone(timezone.utc))
-            # Make sure the volume column are all integers:
-            finnhub_data["v"] = finnhub_data["v"].apply(lambda x: int(x))
-            # Rename the columns:
-            finnhub_data = finnhub_data.rename({'c': 'close_price',
-                                                'h': 'high_price',
-                                                'l': 'low_price',
-                                                'o': 'open_price',
-                                                's': 'status',
-                                                't': 'timestamp',
-                                                'v': 'volume'}, axis=1)
-            return finnhub_data
-
-
-@limit_usage
+        finnhub_data = pd.DataFrame(res)
+        finnhub_data["symbol"] = symbol
+        # Convert the timestamp column to readable form:
+        finnhub_data["t"] = finnhub_data["t"].apply(lambda x:
+                                                    datetime.fromtimestamp(x).astimezone(timezone.utc))
+        # Make sure the volume column are all integers:
+        finnhub_data["v"] = finnhub_data["v"].apply(lambda x: int(x))
+        # Rename the columns:
+        finnhub_data = finnhub_data.rename({'c': 'close_price',
+                                            'h': 'high_price',
+                                            'l': 'low_price',
+                                            'o': 'open_price',
+                                            's': 'status',
+                                            't': 'timestamp',
+                                            'v': 'volume'}, axis=1)
+        return finnhub_data
+
+
 def extract_splits(symbol, dt_start, dt_end):
     """
     Extract splits data through Finnhub API.
@@ -113,7 +147,7 @@ def extract_splits(symbol, dt_start, dt_end):
     :param symbol: (str) Stack abbreviation
     :param dt_start: (datetime)
     :param dt_end: (datetime)
-    :return: (DataFrame) empty dataframe if false to download
+    :return: (DataFrame) empty dataframe if no data, raise FinnhubRequestError if throttled or failed
     """
     # Convert the date inputs to right form:
     if isinstance(dt_start, datetime):
@@ -122,23 +156,13 @@ def extract_splits(symbol, dt_start, dt_end):
     if isinstance(dt_end, datetime):
         dt_end = dt_end.astimezone(timezone.utc)
         dt_end = dt_end.strftime('%Y-%m-%d')
-    # Read finnhub keys
-    api_token = FINNHUB_CONFIG["API_KEY"]
-    api_url = "https://finnhub.io/api/v1/stock/split?symbol={}&from={}&to={}".format(symbol, dt_start, dt_end)
-    api_head = {'X-Finnhub-Token': api_token}
-    # Download the historical daily data from Finnhub:
-    try:
-        res = requests.get(api_url, headers=api_head)
-        df = pd.DataFrame(res.json())
-        if not df.empty:
-            df['source'] = 'api'
-            return df
-        else:
-            return pd.DataFrame()
-    except Exception as e:
-        print('Sorry, when extract {0} splits, because of {1}, '
-              'your request cannot be finished.'.format(symbol, e.__class__))
+    # Download the historical splits data from Finnhub:
+    outcome, res = request_api('/stock/split', {'symbol': symbol, 'from': dt_start, 'to': dt_end}, symbol)
+    if outcome == OUTCOME_EMPTY:
         return pd.DataFrame()
+    df = pd.DataFrame(res)
+    df['source'] = 'api'
+    return df
 
 
 def extract_intraday(symbol, dt_start, dt_end, db_table, upload=True):
@@ -152,7 +176,7 @@ def extract_intraday(symbol, dt_start, dt_end, db_table, upload=True):
     :param dt_end: (datetime)
     :param db_table: (RemoteDatabase)
     :param upload: (boolean) Decide if to upload result directly
-    :return: (DataFrame) empty dataframe if false to download
+    :return: (DataFrame) empty dataframe if no data, raise FinnhubRequestError if throttled or failed
     """
     # Create the time sequence that has a period of 30 days:
     dt_start = dt_start.astimezone(timezone.utc)
@@ -0,0 +1,163 @@
+"""
+This script is to control the Finnhub API usage adaptively.
+The request rate is tuned by AIMD (additive increase, multiplicative decrease)
+and capped by the quota learned from the API rate-limit response headers.
+"""
+import os
+import time
+from datetime import datetime
+from threading import Lock
+
+# Outcomes of one API request, kept separate so that callers can decide what to retry:
+OUTCOME_OK = 'ok'  # Data returned
+OUTCOME_EMPTY = 'empty'  # The API answered but has no data for the request
+OUTCOME_THROTTLED = 'throttled'  # Rejected by the rate limit (HTTP 429)
+OUTCOME_FAILED = 'failed'  # Network error, server error or unreadable response
+OUTCOMES = [OUTCOME_OK, OUTCOME_EMPTY, OUTCOME_THROTTLED, OUTCOME_FAILED]
+
+
+class AdaptiveRateLimiter:
+    """
+    This class is to pace the API calls, and learn the real quota from the responses.
+    """
+
+    def __init__(self, interval, min_interval, max_interval, increase, decrease, window, lock=None):
+        """
+        :param interval: (float) Seconds between two calls at start
+        :param min_interval: (float) The shortest interval allowed before any quota is learned
+        :param max_interval: (float) The longest interval after repeated throttling
+        :param increase: (float) Calls per second added to the rate after each successful call
+        :param decrease: (float) Factor multiplied to the rate when throttled
+        :param window: (float) Seconds of the quota window, the quota header counts calls per window
+        :param lock: (Lock) Shared lock across threads, a new one will be created if None
+        """
+        self.interval, self.min_interval, self.max_interval = interval, min_interval, max_interval
+        self.increase, self.decrease, self.window = increase, decrease, window
+        self.lock = lock if lock is not None else Lock()
+        self.last_use_time = 0
+        self.pause_until = 0  # Set when the quota is used up or throttled
+        self.quota = None  # Calls per window learned from the headers
+        self.counts = {outcome: 0 for outcome in OUTCOMES}
+        self.decisions = {'increase': 0, 'decrease': 0, 'pause': 0}
+        self.wait_seconds = 0.0
+
+    def _floor(self):
+        """
+        The shortest interval allowed, decided by the learned quota if there is one.
+
+        :return: (float)
+        """
+        if self.quota:
+            return self.window / self.quota
+        return self.min_interval
+
+    def wait(self):
+        """
+        Block the current thread until the next call is allowed.
+        """
+        with self.lock:
+            now = time.time()
+            next_time = max(self.last_use_time + self.interval, self.pause_until)
+            if next_time > now:
+                time.sleep(next_time - now)
+                self.wait_seconds += next_time - now
+            self.last_use_time = time.time()
+
+    def feedback(self, outcome, status_code=None, headers=None):
+        """
+        Tune the request rate by the response of the last call.
+
+        :param outcome: (str) One of OUTCOMES
+        :param status_code: (int) HTTP status code, None if no response
+        :param headers: (dict) Response headers, None if no response
+        """
+        headers = headers or {}
+        with self.lock:
+            self.counts[outcome] += 1
+            now = time.time()
+            # Learn the real quota from the headers:
+            limit = _header_number(headers, 'X-Ratelimit-Limit')
+            if limit:
+                self.quota = limit
+                # A lower quota, e.g. plan changed, slows down at once rather than capping the increase only:
+                self.interval = max(self.interval, self._floor())
+            if outcome == OUTCOME_THROTTLED:
+                # Multiplicative decrease of the rate, and hold on until the quota is reset:
+                self.interval = min(self.max_interval, self.interval / self.decrease)
+                self.decisions['decrease'] += 1
+                self.pause_until = max(self.pause_until, now + self._reset_after(headers, now))
+                self.decisions['pause'] += 1
+            elif outcome in [OUTCOME_OK, OUTCOME_EMPTY]:
+                # Additive increase of the rate, no faster than the quota allows:
+                new_interval = max(self._floor(), 1 / (1 / self.interval + self.increase))
+                if new_interval < self.interval:
+                    self.interval = new_interval
+                    self.decisions['increase'] += 1
+                # Stop before the remaining quota run out:
+                remaining = _header_number(headers, 'X-Ratelimit-Remaining')
+                if remaining is not None and remaining <= 1:
+                    self.pause_until = max(self.pause_until, now + self._reset_after(headers, now))
+                    self.decisions['pause'] += 1
+
+    def _reset_after(self, headers, now):
+        """
+        How many seconds to wait until the quota is reset.
+
+        :param headers: (dict) Response headers
+        :param now: (float) Current timestamp
+        :return: (float)
+        """
+        retry_after = _header_number(headers, 'Retry-After')
+        if retry_after is not None:
+            return retry_after
+        reset_time = _header_number(headers, 'X-Ratelimit-Reset')
+        if reset_time is not None and reset_time > now:
+            return min(reset_time - now, self.window)
+        return self.interval
+
+    def metrics(self):
+        """
+        The current state and the decisions made so far.
+
+        :return: (dict)
+        """
+        with self.lock:
+            res = {'time': datetime.today().strftime('%Y-%m-%d %H:%M:%S'),
+                   'interval': round(self.interval, 4),
+                   'quota': self.quota,
+                   'wait_seconds': round(self.wait_seconds, 2)}
+            res.update({'request_' + outcome: count for outcome, count in self.counts.items()})
+            res.update({'decision_' + decision: count for decision, count in self.decisions.items()})
+            return res
+
+    def export_metrics(self, path):
+        """
+        Append the metrics as a row in the csv file.
+
+        :param path: (str) The csv file path
+        :return: (dict) The exported metrics
+        """
+        res = self.metrics()
+        new_file = not os.path.exists(path)
+        with open(path, 'a') as f:
+            if new_file:
+                f.write(",".join(res.keys()) + "\n")
+            f.write(",".join("" if v is None else str(v) for v in res.values()) + "\n")
+        return res
+
+
+def _header_number(headers, name):
+    """
+    Read a number from the response headers.
+
+    :param headers: (dict) Response headers
+    :param name: (str) Header name
+    :return: (float) None if not found or not a number
+    """
+    value = headers.get(name)
+    if value is None:
+        value = headers.get(name.lower())
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
@@ -0,0 +1,44 @@
+"""
+Export script to stream the database tables into compressed files,
+so that the downstream analysis reads the files instead of querying the database.
+"""
+import argparse
+
+import etl_utils.etl_main as etl
+from etl_utils.etl_config import RDS_CONFIG
+
+
+def export_process(table_names, out_dir, file_format='csv', parts=1, full=False):
+    """
+    Export the selected tables one by one.
+
+    :param table_names: (list) Database default table names
+    :param out_dir: (str) Folder to save the exported files
+    :param file_format: (str) 'csv' or 'parquet'
+    :param parts: (int) Number of symbol ranges to export in parallel
+    :param full: (boolean) Ignore the last export watermark and export the whole tables
+    :return: None
+    """
+    for table_name in table_names:
+        with etl.connect_table(table_name) as db_table:
+            db_table.export_table(out_dir, file_format=file_format, parts=parts, full=full)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Export the database tables into compressed files.")
+    parser.add_argument("--table", choices=["daily", "intraday", "split", "all"], default="all",
+                        help="The table to export.")
+    parser.add_argument("--format", choices=["csv", "parquet"], default="csv",
+                        help="The exported file format.")
+    parser.add_argument("--parts", type=int, default=1,
+                        help="Number of symbol ranges to export in parallel.")
+    parser.add_argument("--full", action="store_true",
+                        help="Export the whole table instead of the records since the last export.")
+    parser.add_argument("--out", default=RDS_CONFIG["EXPORT_PATH"],
+                        help="Folder to save the exported files.")
+    args = parser.parse_args()
+    tables = {"daily": [RDS_CONFIG["DAILY_TABLE"]],
+              "intraday": [RDS_CONFIG["INTRADAY_TABLE"]],
+              "split": [RDS_CONFIG["SPLIT_TABLE"]],
+              "all": [RDS_CONFIG["DAILY_TABLE"], RDS_CONFIG["INTRADAY_TABLE"], RDS_CONFIG["SPLIT_TABLE"]]}
+    export_process(tables[args.table], args.out, file_format=args.format, parts=args.parts, full=args.full)
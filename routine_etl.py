@@ -2,7 +2,6 @@
 Routine execute script to update the newest stack data to database.
 """
 import yagmail
-import pandas as pd
 from tqdm import tqdm
 from twilio.rest import Client
 from datetime import datetime
@@ -10,7 +9,9 @@ from threading import Lock
 from concurrent.futures import ThreadPoolExecutor, as_completed
 
 import etl_utils.etl_main as etl
-from etl_utils.etl_config import RDS_CONFIG, ALERT_CONFIG, USER_CUSTOM
+from etl_utils.etl_config import RDS_CONFIG, ALERT_CONFIG, USER_CUSTOM, FINNHUB_CONFIG
+from etl_utils.finnhub_functions import RATE_LIMITER, FinnhubRequestError
+from etl_utils.etl_backfill import backfill
 from stack_info import STACK_LIST
 
 
@@ -19,21 +20,28 @@ def etl_main_process(table_name):
     The main process to execute the ETL, download data from Finnhub and upload to RDS database.
 
     :param table_name: (str) Database default table name
-    :return: None
+    :return: (list) The stacks failed to extract, left to the next routine
     """
 
     with etl.connect_table(table_name) as db_table:
         if USER_CUSTOM["FIRST_RUN"]:
-            stack_list = pd.DataFrame()
-            stack_list.columns = ['symbol', 'last_time', 'volume']
-        else:
-            stack_list = db_table.stack_list()
+            # Bulk load the whole history instead of reloading the stacks one by one,
+            # the staging table is swapped in directly when the table is empty:
+            return backfill(db_table)
+        stack_list = db_table.stack_list()
         # Build process bar to estimate the routine executing time:
         t_stack_list = tqdm(STACK_LIST["name"])
         tb_name = db_table.tb_name
+        failed_list = []
         for stack in t_stack_list:
             t_stack_list.set_description("{} | {}".format(tb_name, stack))
-            etl.main_process(stack, db_table, stack_list)
+            try:
+                etl.main_process(stack, db_table, stack_list)
+            except FinnhubRequestError as e:
+                # Not the same as "no data", leave the stack to the next routine:
+                print("Skip {} | {}".format(stack, e))
+                failed_list.append(stack)
+        return failed_list
 
 
 def routine_process(alert=False, multi_process=False):
@@ -57,19 +65,30 @@ def routine_process(alert=False, multi_process=False):
     total_lock = Lock()
 
     try:
+        failed_stacks = {}
         if multi_process:
             # Set the multiply threads:
             executor = ThreadPoolExecutor(max_workers=2)
             task_1 = executor.submit(etl_main_process, RDS_CONFIG["DAILY_TABLE"])
             task_2 = executor.submit(etl_main_process, RDS_CONFIG["INTRADAY_TABLE"])
-            all_task = [task_1, task_2]
+            all_task = {task_1: RDS_CONFIG["DAILY_TABLE"], task_2: RDS_CONFIG["INTRADAY_TABLE"]}
             for task in as_completed(all_task):
-                print(task.result())
+                failed_stacks[all_task[task]] = task.result()
         else:
-            etl_main_process(RDS_CONFIG["DAILY_TABLE"])
-            etl_main_process(RDS_CONFIG["INTRADAY_TABLE"])
+            failed_stacks[RDS_CONFIG["DAILY_TABLE"]] = etl_main_process(RDS_CONFIG["DAILY_TABLE"])
+            failed_stacks[RDS_CONFIG["INTRADAY_TABLE"]] = etl_main_process(RDS_CONFIG["INTRADAY_TABLE"])
         end_time = datetime.today().strftime('%Y-%m-%d %H:%M:%S')
-        email_msg = ("Routine task starts from {}, successful finished at {}.".format(start_time, end_time))
+        failed_number = sum(len(failed_list) for failed_list in failed_stacks.values())
+        if failed_number:
+            email_msg = ("Routine task starts from {}, finished at {} with {} stacks failed."
+                         .format(start_time, end_time, failed_number))
+        else:
+            email_msg = ("Routine task starts from {}, successful finished at {}.".format(start_time, end_time))
+        for table_name, failed_list in failed_stacks.items():
+            if failed_list:
+                email_msg += "\n{} stacks failed to update {}, left to the next routine: {}".format(
+                    len(failed_list), table_name, failed_list)
+        email_msg += "\nFinnhub API usage: {}".format(RATE_LIMITER.metrics())
         if alert:
             yag.send(to=ALERT_CONFIG["EMAIL_RECEIVER"],
                      subject='ETL routine finished',
@@ -88,6 +107,9 @@ def routine_process(alert=False, multi_process=False):
                                              body=alert_info)
             print(message.sid)
         raise Exception(alert_info)
+    finally:
+        # Export the rate limiter decisions, especially when the routine failed:
+        RATE_LIMITER.export_metrics(FINNHUB_CONFIG["METRICS_PATH"])
 
 
 if __name__ == '__main__':
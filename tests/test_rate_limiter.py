@@ -0,0 +1,70 @@
+"""
+Unit tests of the adaptive rate limiter, no API or database needed.
+"""
+import time
+
+from etl_utils.rate_limiter import AdaptiveRateLimiter, OUTCOME_OK, OUTCOME_EMPTY, OUTCOME_THROTTLED, \
+    OUTCOME_FAILED
+
+
+def build_limiter(interval=1.0):
+    return AdaptiveRateLimiter(interval=interval, min_interval=0.2, max_interval=10,
+                               increase=0.5, decrease=0.5, window=60)
+
+
+def test_increase_until_min_interval():
+    limiter = build_limiter()
+    limiter.feedback(OUTCOME_OK, 200, {})
+    assert abs(limiter.interval - 1 / 1.5) < 1e-9
+    for _ in range(100):
+        limiter.feedback(OUTCOME_EMPTY, 200, {})
+    assert limiter.interval == 0.2
+    assert limiter.metrics()['request_empty'] == 100
+
+
+def test_decrease_when_throttled():
+    limiter = build_limiter()
+    limiter.feedback(OUTCOME_THROTTLED, 429, {'Retry-After': '5'})
+    assert limiter.interval == 2.0
+    assert limiter.pause_until > time.time() + 4
+    for _ in range(10):
+        limiter.feedback(OUTCOME_THROTTLED, 429, {})
+    assert limiter.interval == 10
+    assert limiter.decisions['decrease'] == 11
+
+
+def test_failed_keeps_rate():
+    limiter = build_limiter()
+    limiter.feedback(OUTCOME_FAILED, 503, {})
+    assert limiter.interval == 1.0
+    assert limiter.pause_until == 0
+
+
+def test_pause_when_quota_used_up():
+    limiter = build_limiter()
+    reset_time = time.time() + 30
+    limiter.feedback(OUTCOME_OK, 200, {'X-Ratelimit-Remaining': '1', 'X-Ratelimit-Reset': str(reset_time)})
+    assert abs(limiter.pause_until - reset_time) < 1
+    assert limiter.decisions['pause'] == 1
+
+
+def test_floor_follows_learned_quota():
+    limiter = build_limiter()
+    for _ in range(500):
+        limiter.feedback(OUTCOME_OK, 200, {})
+    assert limiter.interval == 0.2
+    # A higher quota allows faster than min_interval:
+    for _ in range(500):
+        limiter.feedback(OUTCOME_OK, 200, {'X-Ratelimit-Limit': '900'})
+    assert abs(limiter.interval - 60 / 900) < 1e-9
+    # A lower quota slows down at once:
+    limiter.feedback(OUTCOME_OK, 200, {'x-ratelimit-limit': '30'})
+    assert limiter.interval == 2.0
+
+
+def test_wait_keeps_interval():
+    limiter = build_limiter(interval=0.05)
+    limiter.wait()
+    start = time.time()
+    limiter.wait()
+    assert time.time() - start >= 0.04